@@ -0,0 +1,26 @@
+"""Base64 helpers that use pybase64's SIMD codec when installed, else binascii."""
+
+import binascii
+
+try:
+    import pybase64
+except ImportError:
+    # binascii is the C routine behind the base64 module, minus its Python wrapper
+    pybase64 = None
+
+
+def b64encode_str(data):
+    """Encode a bytes-like object to a base64 ASCII string."""
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+def b64decode(data):
+    """Decode base64 text or bytes, ignoring non-alphabet characters like base64.b64decode."""
+    if pybase64 is not None:
+        return pybase64.b64decode(data)
+    return binascii.a2b_base64(data)
+
+
+__all__ = ["b64encode_str", "b64decode"]
@@ -0,0 +1,71 @@
+import hashlib
+import io
+
+from PIL import Image, ImageOps
+
+# Long-edge cap for photos sent to OCR; keeps small table text legible
+OCR_IMAGE_MAX_EDGE = 2048
+OCR_JPEG_QUALITY = 85
+ORIENTATION_TAG = 0x0112
+# Pixels are hashed a strip of rows at a time so no full copy of the raster is made
+DIGEST_STRIP_BYTES = 1 << 20
+
+
+def _pixel_digest(img):
+    """Hash an open image's decoded pixels, size and EXIF orientation."""
+    digest = hashlib.blake2b(digest_size=16)
+    orientation = img.getexif().get(ORIENTATION_TAG, 1)
+    digest.update(f"{img.mode}:{img.size}:{orientation}:{img.info.get('transparency')!r}".encode())
+    # Palette images store colour indices, so the palette decides what they look like
+    palette = img.getpalette()
+    if palette is not None:
+        digest.update(bytes(palette))
+    width, height = img.size
+    row_bytes = max(1, len(img.crop((0, 0, width, 1)).tobytes()))
+    strip_rows = max(1, DIGEST_STRIP_BYTES // row_bytes)
+    for top in range(0, height, strip_rows):
+        digest.update(img.crop((0, top, width, min(top + strip_rows, height))).tobytes())
+    return digest.hexdigest()
+
+
+def _flatten_to_rgb(img):
+    """Convert to RGB, compositing any transparency onto white as JPEG has no alpha."""
+    if img.mode not in ("RGBA", "LA", "PA") and "transparency" not in img.info:
+        return img.convert("RGB")
+    img = img.convert("RGBA")
+    flat = Image.new("RGB", img.size, "white")
+    flat.paste(img, mask=img.getchannel("A"))
+    return flat
+
+
+def _downscale_open_image(img, image_bytes, mime_type, max_edge):
+    """Downscale an already opened image; see ``digest_and_downscale``."""
+    if max(img.size) <= max_edge:
+        return image_bytes, mime_type
+    # Apply EXIF rotation first; the re-encoded JPEG carries no orientation tag
+    img = _flatten_to_rgb(ImageOps.exif_transpose(img))
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=OCR_JPEG_QUALITY)
+    # Already well-compressed originals can come out larger; send whichever is smaller
+    if out.tell() >= len(image_bytes):
+        return image_bytes, mime_type
+    return out.getvalue(), "image/jpeg"
+
+
+def digest_and_downscale(image_bytes, mime_type, max_edge=OCR_IMAGE_MAX_EDGE):
+    """Hash an image and shrink it for OCR, decoding it only once.
+
+    Returns ``(digest, image_bytes, mime_type)``. The digest covers the decoded pixels
+    (plus EXIF orientation), so metadata-only differences match. Oversized images are
+    re-encoded as JPEG; images already within ``max_edge`` or that would not get
+    smaller are returned unchanged. Anything Pillow cannot read is returned unchanged
+    with a digest of its raw bytes.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # Hash before downscaling: exif_transpose and thumbnail change the pixels
+            digest = _pixel_digest(img)
+            return (digest, *_downscale_open_image(img, image_bytes, mime_type, max_edge))
+    except (OSError, Image.DecompressionBombError):
+        return hashlib.blake2b(image_bytes, digest_size=16).hexdigest(), image_bytes, mime_type
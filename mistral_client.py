@@ -15,4 +15,17 @@ else:
             "Please install a compatible `mistralai` version."
         ) from exc
 
-__all__ = ["Mistral"]
+try:
+    from mistralai.utils import BackoffStrategy, RetryConfig
+except ImportError:
+    from mistralai.client.utils import BackoffStrategy, RetryConfig
+
+# Retry 429s and 5xx on every SDK call (upload, signed URL, OCR) with jittered
+# exponential backoff, honouring Retry-After, for up to two minutes per call.
+API_RETRY_CONFIG = RetryConfig(
+    "backoff",
+    BackoffStrategy(initial_interval=500, max_interval=15_000, exponent=1.6, max_elapsed_time=120_000),
+    retry_connection_errors=True,
+)
+
+__all__ = ["API_RETRY_CONFIG", "BackoffStrategy", "Mistral", "RetryConfig"]
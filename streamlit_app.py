@@ -1,12 +1,18 @@
 import streamlit as st
 import os
-import base64
-import json
-import time
+import hashlib
+import orjson
 import re
 import pandas as pd
-from mistral_client import Mistral
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from mistral_client import API_RETRY_CONFIG, Mistral
 from auth import get_app_password, is_valid_password
+from image_prep import digest_and_downscale
+from base64_codec import b64encode_str, b64decode
+
+_SEPARATOR_CELL_RE = re.compile(r'[-:]+')
+
 
 def markdown_table_to_dataframe(table_lines):
     """Convert markdown table lines to a pandas DataFrame."""
@@ -17,7 +23,7 @@ def markdown_table_to_dataframe(table_lines):
     if len(rows) < 2:
         return None
     # Skip separator rows (e.g. |---|:---:|---:|)
-    data_rows = [r for r in rows[1:] if not all(re.match(r'^[-:]+$', c) for c in r)]
+    data_rows = [r for r in rows[1:] if not all(_SEPARATOR_CELL_RE.fullmatch(c) for c in r)]
     if not data_rows:
         return None
     # OCR output can include a short title row as the first markdown row while
@@ -37,22 +43,136 @@ def markdown_table_to_dataframe(table_lines):
             seen[h] = 0
             unique_headers.append(h)
     data_rows = [r[:num_cols] + [''] * (num_cols - len(r)) for r in data_rows]
-    return pd.DataFrame(data_rows, columns=unique_headers)
+    # Every cell is a string, so declare it rather than have pandas infer each column
+    return pd.DataFrame(data_rows, columns=unique_headers, dtype=str)
+
+
+OCR_MODEL = "mistral-ocr-latest"
+# OCR reads an uploaded PDF straight away; one hour is the shortest expiry the API allows
+OCR_SIGNED_URL_EXPIRY_HOURS = 1
 
+# Concurrent OCR requests per "Process" click: default and user-selectable ceiling.
+# Kept low because every extra worker mostly adds 429 retries rather than throughput.
+OCR_DEFAULT_WORKERS = 4
+OCR_MAX_WORKERS = 8
 
 _IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+_LINK_TARGET_RE = re.compile(r'\]\(([^)]+)\)')
 
 
 def replace_images_in_markdown(markdown_text, images):
     """Replace image filename references in markdown with actual base64 data URIs."""
     if not images:
         return markdown_text
+    # Single pass over the markdown with a dict lookup, instead of one full scan per image
+    image_data = {}
     for img in images:
         img_id = img.id if hasattr(img, 'id') else img.get('id', '')
         img_data = img.image_base64 if hasattr(img, 'image_base64') else img.get('image_base64', '')
         if img_id and img_data:
-            markdown_text = markdown_text.replace(f"]({img_id})", f"]({img_data})")
-    return markdown_text
+            image_data.setdefault(img_id, img_data)
+    if not image_data:
+        return markdown_text
+
+    def _swap(match):
+        img_data = image_data.get(match.group(1))
+        return f"]({img_data})" if img_data else match.group(0)
+
+    return _LINK_TARGET_RE.sub(_swap, markdown_text)
+
+
+@st.cache_resource
+def get_mistral_client(api_key):
+    """Share one Mistral client (and its pooled HTTP connections) across reruns and sessions."""
+    return Mistral(api_key=api_key, retry_config=API_RETRY_CONFIG)
+
+
+def upload_pdf_for_ocr(client, uploaded_file):
+    """Stream a local PDF to Mistral file storage and return its file id and a signed URL."""
+    uploaded_file.seek(0)
+    # Not shared with the workspace, and signed only briefly, in case the cleanup delete fails
+    uploaded = client.files.upload(
+        file={"file_name": uploaded_file.name, "content": uploaded_file},
+        purpose="ocr",
+        visibility="user",
+    )
+    signed_url = client.files.get_signed_url(file_id=uploaded.id, expiry=OCR_SIGNED_URL_EXPIRY_HOURS)
+    return uploaded.id, signed_url.url
+
+
+def delete_uploaded_file(client, file_id):
+    """Remove a file uploaded for OCR; cleanup failures must not hide the OCR result."""
+    try:
+        client.files.delete(file_id=file_id)
+    except Exception:
+        pass
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def prepare_image_upload(image_bytes, mime_type):
+    """Return ``(content digest, base64 data URI)`` for sending an uploaded image to OCR.
+
+    Cached so re-processing the same upload skips decoding, re-encoding and base64.
+    Photos re-saved with different metadata still decode to the same digest.
+    """
+    digest, ocr_bytes, ocr_mime_type = digest_and_downscale(image_bytes, mime_type)
+    return digest, f"data:{ocr_mime_type};base64,{b64encode_str(ocr_bytes)}"
+
+
+def ocr_document(client, document, pdf_upload=None):
+    """Run Mistral OCR on one document and return its markdown.
+
+    Local PDFs are passed as ``pdf_upload``: they are uploaded, sent by signed URL
+    and deleted again once OCR has finished.
+    """
+    uploaded_file_id = None
+    try:
+        if pdf_upload is not None:
+            uploaded_file_id, signed_url = upload_pdf_for_ocr(client, pdf_upload)
+            document = {"type": "document_url", "document_url": signed_url}
+        # Rate limits are retried by the client's retry_config instead of pausing after every request
+        ocr_response = client.ocr.process(model=OCR_MODEL, document=document, include_image_base64=True)
+    finally:
+        if uploaded_file_id:
+            delete_uploaded_file(client, uploaded_file_id)
+
+    pages = ocr_response.pages if hasattr(ocr_response, "pages") else (ocr_response if isinstance(ocr_response, list) else [])
+    page_markdowns = []
+    for page in pages:
+        md = page.markdown
+        if hasattr(page, 'images') and page.images:
+            md = replace_images_in_markdown(md, page.images)
+        page_markdowns.append(md)
+    return "\n\n".join(page_markdowns) or "No result found."
+
+
+@st.cache_data(max_entries=128, ttl=60 * 60, show_spinner=False)
+def ocr_upload_markdown(cache_key, _client, _document, _pdf_upload=None):
+    """OCR an uploaded file, cached by ``cache_key`` (a digest of its content).
+
+    Errors propagate so they are not cached.
+    """
+    return ocr_document(_client, _document, _pdf_upload)
+
+
+def run_ocr(client, cache_key, document, pdf_upload=None, use_cache=True):
+    """Return the OCR markdown for one document, or an error message.
+
+    URL sources pass ``use_cache=False``: the document behind a link can change, so
+    only uploads, whose cache key is their content, are served from the cache.
+    """
+    try:
+        if use_cache:
+            return ocr_upload_markdown(cache_key, client, document, pdf_upload)
+        return ocr_document(client, document, pdf_upload)
+    except Exception as e:
+        return f"Error extracting result: {e}"
+
+
+def ocr_result_json(result):
+    """Serialize one OCR result for the JSON download."""
+    # orjson writes UTF-8 bytes directly, so there is no separate str -> bytes encode pass
+    return orjson.dumps({"ocr_result": result}, option=orjson.OPT_INDENT_2)
 
 
 def _flush_markdown_with_images(buffer):
@@ -68,7 +188,7 @@ def _flush_markdown_with_images(buffer):
             caption = m.group(1) or None
             if img_src.startswith("data:"):
                 _, b64_data = img_src.split(",", 1)
-                st.image(base64.b64decode(b64_data), caption=caption)
+                st.image(b64decode(b64_data), caption=caption)
             else:
                 st.image(img_src, caption=caption)
         else:
@@ -77,54 +197,66 @@ def _flush_markdown_with_images(buffer):
         st.markdown("\n".join(text_lines))
 
 
-def parse_and_display_ocr(text):
-    """Parse OCR markdown output and display tables interactively, other content as markdown."""
+def _table_block(table_lines):
+    """Return a ("table", DataFrame) block, or ("markdown", text) if the table can't be parsed."""
+    df = markdown_table_to_dataframe(table_lines)
+    if df is not None:
+        return ("table", df)
+    return ("markdown", "\n".join(table_lines))
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def split_ocr_blocks(text):
+    """Split OCR markdown into table and text blocks, cached so reruns skip re-parsing."""
     lines = text.split("\n")
+    blocks = []
     buffer = []
     table_lines = []
     in_table = False
 
     for line in lines:
-        is_table_line = line.strip().startswith("|") and line.strip().endswith("|")
+        stripped = line.strip()
+        is_table_line = stripped.startswith("|") and stripped.endswith("|")
         if is_table_line:
             if not in_table:
                 # Flush any non-table text
                 if buffer:
-                    _flush_markdown_with_images(buffer)
+                    blocks.append(("text", buffer))
                     buffer = []
                 in_table = True
             table_lines.append(line)
         else:
             if in_table:
-                # End of a table block — render it
-                df = markdown_table_to_dataframe(table_lines)
-                if df is not None:
-                    st.data_editor(
-                        df,
-                        disabled=True,
-                        hide_index=True,
-                        use_container_width=True,
-                    )
-                else:
-                    st.markdown("\n".join(table_lines))
+                # End of a table block
+                blocks.append(_table_block(table_lines))
                 table_lines = []
                 in_table = False
             buffer.append(line)
 
     # Flush remaining content
     if in_table and table_lines:
-        df = markdown_table_to_dataframe(table_lines)
-        if df is not None:
+        blocks.append(_table_block(table_lines))
+    if buffer:
+        blocks.append(("text", buffer))
+    return blocks
+
+
+def parse_and_display_ocr(text, key_prefix="ocr"):
+    """Parse OCR markdown output and display tables interactively, other content as markdown."""
+    for block_idx, (kind, content) in enumerate(split_ocr_blocks(text)):
+        if kind == "table":
+            # Explicit keys let identical tables (e.g. duplicate uploads) render side by side
             st.data_editor(
-                df,
+                content,
                 disabled=True,
                 hide_index=True,
                 use_container_width=True,
+                key=f"{key_prefix}_table_{block_idx}",
             )
+        elif kind == "markdown":
+            st.markdown(content)
         else:
-            st.markdown("\n".join(table_lines))
-    if buffer:
-        _flush_markdown_with_images(buffer)
+            _flush_markdown_with_images(content)
 
 
 st.set_page_config(layout="wide", page_title="Tuber Tracker", page_icon="🥔")
@@ -152,6 +284,10 @@ if "preview_src" not in st.session_state:
     st.session_state["preview_src"] = []
 if "image_bytes" not in st.session_state:
     st.session_state["image_bytes"] = []
+if "processed_file_type" not in st.session_state:
+    st.session_state["processed_file_type"] = None
+if "processed_source_type" not in st.session_state:
+    st.session_state["processed_source_type"] = None
 if "is_authenticated" not in st.session_state:
     st.session_state["is_authenticated"] = False
 
@@ -181,84 +317,127 @@ source_type = st.radio("Select source type", ("Local Upload", "URL"))
 input_url = ""
 uploaded_files = []
 
-if source_type == "URL":
-    input_url = st.text_area("Enter one or multiple URLs (separate with new lines)")
-else:
-    uploaded_files = st.file_uploader("Upload one or more files", type=["pdf", "jpg", "jpeg", "png"], accept_multiple_files=True)
+# Inputs live in a form so typing URLs or uploading files doesn't rerun the whole
+# app (and re-render every result) until Process is clicked
+with st.form("ocr_form"):
+    if source_type == "URL":
+        input_url = st.text_area("Enter one or multiple URLs (separate with new lines)")
+    else:
+        uploaded_files = st.file_uploader("Upload one or more files", type=["pdf", "jpg", "jpeg", "png"], accept_multiple_files=True)
+
+    ocr_workers = st.slider(
+        "Parallel OCR requests",
+        min_value=1,
+        max_value=OCR_MAX_WORKERS,
+        value=OCR_DEFAULT_WORKERS,
+        help="Lower this if you hit the Mistral API rate limit.",
+    )
+    process_clicked = st.form_submit_button("Process")
 
 # 4. Process Button & OCR Handling
-if st.button("Process"):
+if process_clicked:
     if source_type == "URL" and not input_url.strip():
         st.error("Please enter at least one valid URL.")
     elif source_type == "Local Upload" and not uploaded_files:
         st.error("Please upload at least one file.")
     else:
-        client = Mistral(api_key=api_key)
+        client = get_mistral_client(api_key)
         st.session_state["ocr_result"] = []
         st.session_state["preview_src"] = []
         st.session_state["image_bytes"] = []
+        # The display below must follow how these results were produced, not the current radios
+        st.session_state["processed_file_type"] = file_type
+        st.session_state["processed_source_type"] = source_type
         
-        sources = input_url.split("\n") if source_type == "URL" else uploaded_files
+        if source_type == "URL":
+            # Blank lines would each cost a failed OCR request
+            sources = [url for url in input_url.split("\n") if url.strip()]
+        else:
+            sources = uploaded_files
         
-        for idx, source in enumerate(sources):
-            if file_type == "PDF":
-                if source_type == "URL":
-                    document = {"type": "document_url", "document_url": source.strip()}
-                    preview_src = source.strip()
+        # OCR calls are network-bound, so overlap them with each other and with preparing
+        # the next file; results keep the upload order. Workers get the script context so
+        # the cached OCR call for uploads can run inside them.
+        cache_keys = []
+        futures = {}
+        results = {}
+        progress = st.progress(0.0, text="Preparing file(s)...")
+        with ThreadPoolExecutor(
+            max_workers=min(ocr_workers, len(sources)),
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx()),
+        ) as executor:
+            for source in sources:
+                pdf_upload = None
+                if file_type == "PDF":
+                    if source_type == "URL":
+                        cache_key = (file_type, source.strip())
+                        document = {"type": "document_url", "document_url": source.strip()}
+                        preview_src = source.strip()
+                    else:
+                        # Key cached OCR results on the upload's content rather than its name.
+                        # getvalue() shares the upload's bytes object; getbuffer() would force a full copy.
+                        cache_key = (file_type, hashlib.blake2b(source.getvalue(), digest_size=16).hexdigest())
+                        # Uploaded by the OCR worker and passed by signed URL
+                        document = None
+                        preview_src = None
+                        pdf_upload = source
                 else:
-                    file_bytes = source.read()
-                    encoded_pdf = base64.b64encode(file_bytes).decode("utf-8")
-                    document = {"type": "document_url", "document_url": f"data:application/pdf;base64,{encoded_pdf}"}
-                    preview_src = f"data:application/pdf;base64,{encoded_pdf}"
-            else:
-                if source_type == "URL":
-                    document = {"type": "image_url", "image_url": source.strip()}
-                    preview_src = source.strip()
-                else:
-                    file_bytes = source.read()
-                    mime_type = source.type
-                    encoded_image = base64.b64encode(file_bytes).decode("utf-8")
-                    document = {"type": "image_url", "image_url": f"data:{mime_type};base64,{encoded_image}"}
-                    preview_src = f"data:{mime_type};base64,{encoded_image}"
-                    st.session_state["image_bytes"].append(file_bytes)
-            
-            with st.spinner(f"Processing {source if source_type == 'URL' else source.name}..."):
-                try:
-                    ocr_response = client.ocr.process(model="mistral-ocr-latest", document=document, include_image_base64=True)
-                    time.sleep(1)  # wait 1 second between request to prevent rate limit exceeding
-                    
-                    pages = ocr_response.pages if hasattr(ocr_response, "pages") else (ocr_response if isinstance(ocr_response, list) else [])
-                    page_markdowns = []
-                    for page in pages:
-                        md = page.markdown
-                        if hasattr(page, 'images') and page.images:
-                            md = replace_images_in_markdown(md, page.images)
-                        page_markdowns.append(md)
-                    result_text = "\n\n".join(page_markdowns) or "No result found."
-                except Exception as e:
-                    result_text = f"Error extracting result: {e}"
-                
-                st.session_state["ocr_result"].append(result_text)
+                    if source_type == "URL":
+                        cache_key = (file_type, source.strip())
+                        document = {"type": "image_url", "image_url": source.strip()}
+                        preview_src = source.strip()
+                    else:
+                        file_bytes = source.getvalue()
+                        digest, data_uri = prepare_image_upload(file_bytes, source.type)
+                        cache_key = (file_type, digest)
+                        document = {"type": "image_url", "image_url": data_uri}
+                        # Previewed from image_bytes, so don't keep a second base64 copy in session state
+                        preview_src = None
+                        st.session_state["image_bytes"].append(file_bytes)
                 st.session_state["preview_src"].append(preview_src)
+                cache_keys.append(cache_key)
+                # Identical files (same URL or same content) are only sent to OCR once
+                if cache_key not in results:
+                    results[cache_key] = None
+                    futures[executor.submit(
+                        run_ocr, client, cache_key, document, pdf_upload, use_cache=source_type != "URL"
+                    )] = cache_key
+
+            # Duplicates share one request, so the total is only known once all are submitted
+            progress.progress(0.0, text=f"Processing {len(futures)} file(s)...")
+            # Report each file as soon as it finishes instead of waiting for the whole batch
+            for done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                progress.progress(done / len(futures), text=f"Processed {done} of {len(futures)} file(s)")
+        progress.empty()
+        st.session_state["ocr_result"] = [results[cache_key] for cache_key in cache_keys]
 
 # 5. Display Preview and OCR Results if available
 if st.session_state["ocr_result"]:
     for idx, result in enumerate(st.session_state["ocr_result"]):
         st.subheader(f"OCR Results {idx+1}")
-        if file_type != "PDF":
-            if source_type == "Local Upload" and st.session_state["image_bytes"]:
+        if st.session_state["processed_file_type"] != "PDF":
+            if st.session_state["processed_source_type"] == "Local Upload" and st.session_state["image_bytes"]:
                 st.image(st.session_state["image_bytes"][idx])
-            else:
+            elif st.session_state["preview_src"][idx] is not None:
+                # Local PDFs are sent by short-lived signed URL and have no preview to show
                 st.image(st.session_state["preview_src"][idx])
 
-        def create_download_link(data, filetype, filename):
-            b64 = base64.b64encode(data.encode()).decode()
-            href = f'<a href="data:{filetype};base64,{b64}" download="{filename}">Download {filename}</a>'
-            st.markdown(href, unsafe_allow_html=True)
-
-        json_data = json.dumps({"ocr_result": result}, ensure_ascii=False, indent=2)
-        create_download_link(json_data, "application/json", f"Output_{idx+1}.json") # json output
-        create_download_link(result, "text/plain", f"Output_{idx+1}.txt") # plain text output
-        create_download_link(result, "text/markdown", f"Output_{idx+1}.md") # markdown output
+        # Payloads are only built when a button is clicked, and the click doesn't rerun the app
+        for extension, mime, payload in (
+            ("json", "application/json", lambda result=result: ocr_result_json(result)), # json output
+            ("txt", "text/plain", lambda result=result: result), # plain text output
+            ("md", "text/markdown", lambda result=result: result), # markdown output
+        ):
+            filename = f"Output_{idx+1}.{extension}"
+            st.download_button(
+                f"Download {filename}",
+                data=payload,
+                file_name=filename,
+                mime=mime,
+                on_click="ignore",
+                key=f"download_{idx}_{extension}",
+            )
 
-        parse_and_display_ocr(result)
+        parse_and_display_ocr(result, key_prefix=f"ocr_{idx}")
@@ -1,20 +1,37 @@
+import io
 import re
 import inspect
 import pandas as pd
 import pytest
 from auth import get_app_password, is_valid_password
+from image_prep import digest_and_downscale
+import base64_codec
+
+
+_LINK_TARGET_RE = re.compile(r'\]\(([^)]+)\)')
 
 
 def replace_images_in_markdown(markdown_text, images):
     """Copy of function under test (avoids importing streamlit)."""
     if not images:
         return markdown_text
+    image_data = {}
     for img in images:
         img_id = img.get('id', '')
         img_data = img.get('image_base64', '')
         if img_id and img_data:
-            markdown_text = markdown_text.replace(f"]({img_id})", f"]({img_data})")
-    return markdown_text
+            image_data.setdefault(img_id, img_data)
+    if not image_data:
+        return markdown_text
+
+    def _swap(match):
+        img_data = image_data.get(match.group(1))
+        return f"]({img_data})" if img_data else match.group(0)
+
+    return _LINK_TARGET_RE.sub(_swap, markdown_text)
+
+
+_SEPARATOR_CELL_RE = re.compile(r'[-:]+')
 
 
 def markdown_table_to_dataframe(table_lines):
@@ -25,7 +42,7 @@ def markdown_table_to_dataframe(table_lines):
         rows.append(cells)
     if len(rows) < 2:
         return None
-    data_rows = [r for r in rows[1:] if not all(re.match(r'^[-:]+$', c) for c in r)]
+    data_rows = [r for r in rows[1:] if not all(_SEPARATOR_CELL_RE.fullmatch(c) for c in r)]
     if not data_rows:
         return None
     max_data_cols = max(len(r) for r in data_rows)
@@ -41,7 +58,7 @@ def markdown_table_to_dataframe(table_lines):
             seen[h] = 0
             unique_headers.append(h)
     data_rows = [r[:num_cols] + [''] * (num_cols - len(r)) for r in data_rows]
-    return pd.DataFrame(data_rows, columns=unique_headers)
+    return pd.DataFrame(data_rows, columns=unique_headers, dtype=str)
 
 
 def test_unique_columns():
@@ -242,3 +259,252 @@ def test_mistral_client_compat_import():
 
     assert Mistral is not None
     assert "api_key" in inspect.signature(Mistral).parameters
+
+
+def test_api_retry_config_retries_rate_limits():
+    """Every SDK call should back off on 429 and honour Retry-After."""
+    httpx = pytest.importorskip("httpx2")
+    from mistral_client import API_RETRY_CONFIG, Mistral
+
+    assert API_RETRY_CONFIG.strategy == "backoff"
+    assert API_RETRY_CONFIG.backoff.max_elapsed_time >= 60_000
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        if len(calls) < 3:
+            return httpx.Response(429, headers={"retry-after": "0.01"}, json={"message": "rate limited"})
+        return httpx.Response(200, json={"url": "https://signed"})
+
+    client = Mistral(
+        api_key="test",
+        client=httpx.Client(transport=httpx.MockTransport(handler)),
+        retry_config=API_RETRY_CONFIG,
+    )
+    assert client.files.get_signed_url(file_id="f1").url == "https://signed"
+    assert len(calls) == 3
+
+
+def _png_bytes(size, noisy=False):
+    from PIL import Image
+
+    img = Image.effect_noise(size, 64).convert("RGB") if noisy else Image.new("RGB", size, "white")
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+def test_digest_and_downscale_shrinks_large_images():
+    """Oversized images should be capped on the long edge and re-encoded as JPEG."""
+    from PIL import Image
+
+    _, data, mime = digest_and_downscale(_png_bytes((400, 100), noisy=True), "image/png", max_edge=200)
+    assert mime == "image/jpeg"
+    assert Image.open(io.BytesIO(data)).size == (200, 50)
+
+
+def test_digest_and_downscale_passes_through():
+    """Small images and unreadable data should be returned unchanged."""
+    import hashlib
+
+    small = _png_bytes((50, 50))
+    assert digest_and_downscale(small, "image/png", max_edge=200)[1:] == (small, "image/png")
+    # Unreadable data falls back to a digest of the raw bytes
+    assert digest_and_downscale(b"not an image", "image/png") == (
+        hashlib.blake2b(b"not an image", digest_size=16).hexdigest(), b"not an image", "image/png"
+    )
+    # A flat PNG compresses far better than any JPEG, so re-encoding would only grow it
+    flat = _png_bytes((4000, 4000))
+    assert digest_and_downscale(flat, "image/png", max_edge=3000)[1:] == (flat, "image/png")
+
+
+@pytest.mark.parametrize("use_pybase64", [True, False])
+def test_base64_codec_matches_stdlib(monkeypatch, use_pybase64):
+    """Both the pybase64 and binascii paths should match the stdlib base64 module."""
+    import base64
+
+    if not use_pybase64:
+        monkeypatch.setattr(base64_codec, "pybase64", None)
+    data = bytes(range(256)) * 3 + b"x"
+    expected = base64.b64encode(data).decode()
+    assert base64_codec.b64encode_str(data) == expected
+    assert base64_codec.b64encode_str(memoryview(data)) == expected
+    assert base64_codec.b64decode(expected) == data
+
+
+def test_replace_images_repeated_reference():
+    """Every reference to the same image id should be replaced."""
+    md = "![a.png](a.png) then again ![a.png](a.png) and [link](other)"
+    images = [{"id": "a.png", "image_base64": "data:image/png;base64,AAA"}]
+    result = replace_images_in_markdown(md, images)
+    assert result.count("](data:image/png;base64,AAA)") == 2
+    assert "[link](other)" in result
+
+
+def test_digest_and_downscale_ignores_metadata():
+    """Same pixels saved with different metadata should share a digest."""
+    from PIL import Image, PngImagePlugin
+
+    img = Image.effect_noise((32, 32), 64).convert("RGB")
+    plain = io.BytesIO()
+    img.save(plain, "PNG")
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "second shot")
+    tagged = io.BytesIO()
+    img.save(tagged, "PNG", pnginfo=info)
+
+    assert plain.getvalue() != tagged.getvalue()
+    plain_digest = digest_and_downscale(plain.getvalue(), "image/png")[0]
+    assert plain_digest == digest_and_downscale(tagged.getvalue(), "image/png")[0]
+    assert plain_digest != digest_and_downscale(_png_bytes((32, 32)), "image/png")[0]
+
+
+def test_digest_and_downscale_strips_match_full_raster(monkeypatch):
+    """Hashing in row strips should give the same digest as hashing the whole raster."""
+    import hashlib
+
+    import image_prep
+    from PIL import Image
+
+    img = Image.effect_noise((40, 37), 64).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    expected = hashlib.blake2b(digest_size=16)
+    expected.update(f"{img.mode}:{img.size}:1:None".encode())
+    expected.update(img.tobytes())
+
+    monkeypatch.setattr(image_prep, "DIGEST_STRIP_BYTES", 40 * 3 * 5)
+    assert digest_and_downscale(buf.getvalue(), "image/png")[0] == expected.hexdigest()
+
+
+def test_digest_and_downscale_flattens_transparency_onto_white():
+    """Dark text on a transparent background must stay readable once re-encoded as JPEG."""
+    from PIL import Image, ImageDraw, ImageStat
+
+    img = Image.new("RGBA", (3000, 1000), (0, 0, 0, 0))
+    noise = Image.effect_noise((3000, 1000), 64).convert("L")
+    img.putalpha(noise.point(lambda v: 255 if v > 200 else 0))
+    ImageDraw.Draw(img).rectangle((100, 100, 1000, 400), fill=(0, 0, 0, 255))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+
+    _, data, mime = digest_and_downscale(buf.getvalue(), "image/png", max_edge=1500)
+    assert mime == "image/jpeg"
+    out = Image.open(io.BytesIO(data)).convert("L")
+    # Transparent areas come out white and the opaque black box stays black
+    assert ImageStat.Stat(out).mean[0] > 180
+    assert out.getpixel((250, 120)) < 50
+
+
+def test_digest_and_downscale_includes_palette():
+    """Palette images with the same indices but different palettes must not collide."""
+    from PIL import Image
+
+    img = Image.effect_noise((32, 32), 64).convert("RGB").quantize(16)
+    inverted = img.copy()
+    inverted.putpalette([255 - v for v in img.getpalette()])
+    encoded = []
+    for candidate in (img, inverted):
+        buf = io.BytesIO()
+        candidate.save(buf, "PNG")
+        encoded.append(buf.getvalue())
+
+    assert Image.open(io.BytesIO(encoded[0])).tobytes() == Image.open(io.BytesIO(encoded[1])).tobytes()
+    digests = {digest_and_downscale(data, "image/png")[0] for data in encoded}
+    assert len(digests) == 2
+
+
+class _FakeFiles:
+    def __init__(self):
+        self.uploads = []
+        self.signed = []
+        self.deleted = []
+
+    def upload(self, file, purpose, visibility="workspace"):
+        self.uploads.append({"file_name": file["file_name"], "purpose": purpose, "visibility": visibility})
+        return type("Uploaded", (), {"id": f"file-{len(self.uploads)}"})()
+
+    def get_signed_url(self, file_id, expiry=24):
+        self.signed.append((file_id, expiry))
+        return type("SignedUrl", (), {"url": f"https://signed/{file_id}"})()
+
+    def delete(self, file_id):
+        self.deleted.append(file_id)
+
+
+class _FakeOCR:
+    def __init__(self):
+        self.documents = []
+        self.errors = {}
+
+    def process(self, model, document, include_image_base64):
+        self.documents.append(document)
+        url = document.get("document_url") or document.get("image_url")
+        if url in self.errors:
+            raise self.errors[url]
+        page = type("Page", (), {"markdown": f"# {url}", "images": []})()
+        return type("Response", (), {"pages": [page]})()
+
+
+class _FakeMistral:
+    def __init__(self, api_key=None, **kwargs):
+        self.files = _FakeFiles()
+        self.ocr = _FakeOCR()
+
+
+@pytest.fixture
+def ocr_app(monkeypatch):
+    """Run the app, already unlocked, against a fake Mistral client."""
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+
+    import mistral_client
+
+    client = _FakeMistral()
+    monkeypatch.setenv("MISTRAL_API_KEY", "test")
+    monkeypatch.setenv("TUBER_TRACKER_PASSWORD", "test")
+    monkeypatch.setattr(mistral_client, "Mistral", lambda **kwargs: client)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    at = AppTest.from_file("streamlit_app.py", default_timeout=30)
+    at.session_state["is_authenticated"] = True
+    at.run()
+    yield at, client
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+
+def _click_process(at):
+    next(b for b in at.button if b.label == "Process").click().run()
+    assert not at.exception
+
+
+def test_local_pdf_upload_is_private_and_deleted_when_ocr_fails(ocr_app):
+    """A failed OCR request must still delete the uploaded PDF and report the error."""
+    at, client = ocr_app
+    client.ocr.errors["https://signed/file-1"] = RuntimeError("service unavailable")
+    at.file_uploader[0].set_value([("scan.pdf", b"%PDF-1.4 test", "application/pdf")])
+    _click_process(at)
+
+    assert client.files.uploads == [{"file_name": "scan.pdf", "purpose": "ocr", "visibility": "user"}]
+    assert client.files.signed == [("file-1", 1)]
+    assert client.files.deleted == ["file-1"]
+    assert at.session_state["ocr_result"] == ["Error extracting result: service unavailable"]
+
+
+def test_url_batch_dedupes_requests_and_keeps_input_order(ocr_app):
+    """Blank lines are skipped, duplicates share one request, and failures stay in place."""
+    at, client = ocr_app
+    client.ocr.errors["https://b/2.pdf"] = RuntimeError("not a PDF")
+    at.radio[1].set_value("URL").run()
+    at.text_area[0].input("https://a/1.pdf\n\nhttps://b/2.pdf\n  \nhttps://a/1.pdf\nhttps://c/3.pdf\n")
+    _click_process(at)
+
+    requested = [doc["document_url"] for doc in client.ocr.documents]
+    assert sorted(requested) == ["https://a/1.pdf", "https://b/2.pdf", "https://c/3.pdf"]
+    assert at.session_state["ocr_result"] == [
+        "# https://a/1.pdf",
+        "Error extracting result: not a PDF",
+        "# https://a/1.pdf",
+        "# https://c/3.pdf",
+    ]